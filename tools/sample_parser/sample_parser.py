@@ -1,63 +1,137 @@
-import re 
-import string
-from collections import defaultdict
-from operator import itemgetter
-
 """
-To use this script: 
-First perform an objdump on kernel.bin in build/grub-isofiles/boot and copy the file into this folder as "objdump_output", then 
-use the print_samples() function in the pmu_x86 crate to print the sampled instruction pointers and task IDs, and copy into this folder 
-in a text file named "ips_sampled". 
+To use this script:
+First perform an objdump on kernel.bin in build/grub-isofiles/boot and copy the file into this folder as "objdump_output", then
+use the print_samples() function in the pmu_x86 crate to print the sampled instruction pointers and task IDs, and copy into this folder
+in a text file named "ips_sampled". Then run this script with Python 3 from this folder.
+Optionally, `pip install ahocorasick-rs` first: it is not required, but it makes matching IPs in large objdumps much faster.
 """
 
-instruction_regex = re.compile('(\\s{2,})([a-z])+(?=\\s+)') # Regex to capture instructions types 
-function_regex = re.compile('<(.)*>:') # Regex to capture function names from objdump
-bin_file = open("objdump_output", )
-ip_file = open("ips_sampled", )
-ip_list = [] # List of instruction pointers retrieved from ip_file
-id_list = [] # Task ID index matches with IP it came from
-function_instruction = [] # Matches each function and instruction recorded in a list of tuples
-ip_frequency_per_id = defaultdict(lambda: defaultdict(int))
-function_frequency_per_id = defaultdict(lambda: defaultdict(int))
-ip_frequency = defaultdict(int)
-function_freq = defaultdict(int)
-enclosing_function = ""
-
-# Iterates through files that store IPs and associated task ID and places them into lists
-for line in ip_file:
-    ip_list.append(line[4:20])
-    id_list.append(line[21:22])
-
-
-ip_list_len = len(ip_list)*1.0
-
-# Iterates through the objdump output file. For each line in the file, it checks to see if the IP is contained in it and if it is, 
-# checks to see if the line has a decipherable instruction in it and records the instruction and enclosing function if it does.
-# Also records the function that the IP is enclosed in by keeping track of the most recent function name in the file. 
-for line in bin_file:
-    possible_function = function_regex.search(line)
-    if not possible_function == None:
-        enclosing_function = possible_function.group(0)
-    for idx, ip in enumerate(ip_list):
-        if ip in line:
-            m = instruction_regex.search(line)
+import bisect
+import mmap
+import os
+import re
+from collections import Counter, defaultdict
+
+try:
+    import ahocorasick_rs
+except ImportError:
+    ahocorasick_rs = None
+
+
+def main():
+    instruction_regex = re.compile(rb'(\s{2,})([a-z])+(?=\s+)') # Regex to capture instructions types
+    # Regex to capture function names from the function header lines in objdump. It is anchored to the start of a header line so that
+    # operands like "call ... <<T as X>::f+0x10>" on instruction lines are not mistaken for function names.
+    function_regex = re.compile(rb'^[0-9a-f]+ (<.*>:)', re.M)
+    ip_format_regex = re.compile('[0-9a-fA-F]{16}') # Regex to validate the IPs retrieved from ip_file
+    ip_to_ids = defaultdict(list) # Maps each IP retrieved from ip_file to the task IDs it was sampled under, one per sample
+    function_instruction = [] # Matches each function and instruction recorded in a list of tuples
+    ip_frequency = Counter() # Counts of each (task ID, instruction) pair
+    function_frequency = Counter() # Counts of each (task ID, enclosing function) pair
+    ip_list_len = 0.0
+
+    # Iterates through files that store IPs and associated task ID and groups the task IDs by IP
+    with open("ips_sampled", 'r') as ip_file:
+        ip_lines = ip_file.read().splitlines()
+    for line in ip_lines:
+        ip = line[4:20]
+        if not ip_format_regex.fullmatch(ip): # Skips blank or malformed lines, which would otherwise become bogus patterns
+            continue
+        ip_to_ids[ip.encode()].append(line[21:22])
+        ip_list_len += 1
+
+    # Builds a single matcher over all IPs so that the objdump is scanned once, rather than once per IP.
+    # Uses the Rust aho-corasick crate if the ahocorasick_rs package is installed, which scans the memory-mapped objdump
+    # directly and returns every match in one call. Otherwise falls back to one alternation regex.
+    ip_patterns = list(ip_to_ids)
+    if ahocorasick_rs is not None:
+        ip_automaton = ahocorasick_rs.BytesAhoCorasick(ip_patterns, matchkind=ahocorasick_rs.MatchKind.LeftmostFirst)
+    else:
+        ip_regex = re.compile(b'|'.join(map(re.escape, ip_patterns)) or b'(?!)')
+
+    def find_ips(data):
+        """Yields a (start offset, IP) tuple for every sampled IP found in the given bytes, in order."""
+        if ahocorasick_rs is not None:
+            for pattern_idx, start, _ in ip_automaton.find_matches_as_indexes(data):
+                yield start, ip_patterns[pattern_idx]
+        else:
+            for m in ip_regex.finditer(data):
+                yield m.start(), m.group(0)
+
+    def find_function_headers(data):
+        """Returns an (offset, name) tuple for the start of every function header line in the given bytes, in order."""
+        # Every header line contains ">:", so this jumps between occurrences of it with a fast substring search and only runs
+        # function_regex on the lines containing one, rather than running the regex engine over the whole objdump.
+        # Demangled Rust symbols contain ">::" as well, so a line may contain several occurrences; each candidate line is
+        # matched exactly once, in full, and the search resumes after it.
+        headers = []
+        pos = data.find(b">:")
+        while pos != -1:
+            line_start = data.rfind(b"\n", 0, pos) + 1
+            line_end = data.find(b"\n", pos)
+            if line_end == -1:
+                line_end = len(data)
+            m = function_regex.match(data, line_start, line_end)
             if not m == None:
-                ip_frequency_per_id[id_list[idx]][m.group(0).lstrip()] += 1
-                function_frequency_per_id[id_list[idx]][enclosing_function] += 1
-                function_instruction.append((enclosing_function, m.group(0).lstrip()))
-            else: 
-                ip_frequency_per_id[id_list[idx]]["Function Header IP (no associated instruction)"] += 1
-                function_frequency_per_id[id_list[idx]][enclosing_function] += 1
-                function_instruction.append((enclosing_function, "Function Header IP"))
-
-            ip_list.remove(ip)
-
-# Prints the frequencies of the instructions and tasks. 
-for id in function_frequency_per_id.keys():
-    print "FOR ID: {}".format(id)
-    for function, freq in sorted(function_frequency_per_id[id].items(), key=itemgetter(1), reverse=True):
-        print  function, freq/ip_list_len
-    for instruction, freq in sorted(ip_frequency_per_id[id].items(), key=itemgetter(1), reverse=True):
-        print instruction, freq/ip_list_len
-
-print "Samples taken: {}".format(ip_list_len)
+                headers.append((line_start, m.group(1).decode()))
+            pos = data.find(b">:", line_end)
+        return headers
+
+    # Scans the objdump output file once for function headers, recording the offset at which each function begins,
+    # and once for the sampled IPs. For the first occurrence of each outstanding IP, it checks to see if the line containing it
+    # has a decipherable instruction in it and records the instruction and enclosing function for every sample of that IP.
+    # The enclosing function is the last function header at or before the IP's offset, found by bisecting the header offsets.
+    # An IP is removed from ip_to_ids once it is found, and the scan stops early once every IP has been found.
+    # The objdump is memory-mapped and scanned as raw bytes, since it can be hundreds of MB and decoding all of it is wasted work.
+    with open("objdump_output", 'rb') as bin_file:
+        # mmap cannot map an empty file, and an empty objdump has nothing to scan anyway
+        if os.fstat(bin_file.fileno()).st_size != 0:
+            with mmap.mmap(bin_file.fileno(), 0, access=mmap.ACCESS_READ) as bin_map:
+                function_headers = find_function_headers(bin_map)
+                function_offsets = [offset for offset, _ in function_headers]
+
+                for pos, ip in find_ips(bin_map):
+                    if not ip_to_ids:
+                        break
+                    ids = ip_to_ids.pop(ip, None)
+                    if ids is None:
+                        continue
+                    line_start = bin_map.rfind(b"\n", 0, pos) + 1
+                    line_end = bin_map.find(b"\n", pos) + 1 # Keeps the newline, as instruction_regex expects whitespace after the instruction
+                    if line_end == 0:
+                        line_end = len(bin_map)
+                    m = instruction_regex.search(bin_map[line_start:line_end])
+                    header_idx = bisect.bisect_right(function_offsets, pos) - 1
+                    function = function_headers[header_idx][1] if header_idx >= 0 else ""
+                    for id in ids:
+                        if not m == None:
+                            instruction = m.group(0).lstrip().decode()
+                            ip_frequency[(id, instruction)] += 1
+                            function_frequency[(id, function)] += 1
+                            function_instruction.append((function, instruction))
+                        else:
+                            ip_frequency[(id, "Function Header IP (no associated instruction)")] += 1
+                            function_frequency[(id, function)] += 1
+                            function_instruction.append((function, "Function Header IP"))
+
+    # Groups the frequencies by task ID, most frequent first.
+    functions_per_id = defaultdict(list)
+    for (id, function), freq in function_frequency.most_common():
+        functions_per_id[id].append((function, freq))
+    instructions_per_id = defaultdict(list)
+    for (id, instruction), freq in ip_frequency.most_common():
+        instructions_per_id[id].append((instruction, freq))
+
+    # Prints the frequencies of the instructions and tasks.
+    for id in functions_per_id.keys():
+        print("FOR ID: {}".format(id))
+        for function, freq in functions_per_id[id]:
+            print(function, freq/ip_list_len)
+        for instruction, freq in instructions_per_id[id]:
+            print(instruction, freq/ip_list_len)
+
+    print("Samples taken: {}".format(ip_list_len))
+
+
+if __name__ == '__main__':
+    main()